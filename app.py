@@ -4,10 +4,15 @@ import docker
 import sys
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+from docker.errors import ImageNotFound
 from flask import Flask
 from blueprint import aptb
 from globus_action_provider_tools.flask.helpers import assign_json_provider
 
+# Build context for the computation image, resolved once at import
+RESOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "method_resources/computation_docker")
+
 def create_app():
     app = Flask(__name__)
     assign_json_provider(app)
@@ -15,21 +20,24 @@ def create_app():
     app.config.from_object(config)
     app.register_blueprint(aptb)
 
+    # Single Docker client shared by every action run (see run_computation)
+    docker_client = docker.from_env(max_pool_size=16)
+    app.extensions['docker'] = docker_client
+    # Worker pool for container runs, so action requests don't block on them
+    app.extensions['executor'] = ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2)
+
     # Check if docker image is available
-    docker_client = docker.from_env()
     image_name = "computation_image:latest"
-    image_list = [img.tags[0] for img in docker_client.images.list() if img.tags]
-    if image_name not in image_list:
+    try:
+        docker_client.images.get(image_name)
+        print(f"Docker image found: {image_name}")
+    except ImageNotFound:
         # If image is not avaliable, try to build it
         try: 
-            resource_dir = os.path.dirname(os.path.abspath(__file__))
-            resource_dir = os.path.join(resource_dir, "method_resources/computation_docker")
-            docker_client.images.build(path=resource_dir, tag=image_name)
+            docker_client.images.build(path=RESOURCE_DIR, tag=image_name)
         except Exception as e:
             print(f"An error occurred: {e}. Your additional comment goes here.")
             sys.exit(1)
-    else:
-        print(f"Docker image found: {image_name}")
 
     return app
 
@@ -1,20 +1,119 @@
-from typing import Dict, Tuple
+import threading
+from collections import defaultdict
+from itertools import chain
+from typing import Any, Collection, Dict, FrozenSet, Iterable, Iterator, Optional, Set, Tuple
 
-from globus_action_provider_tools import ActionStatus
+from globus_action_provider_tools import ActionStatus, ActionStatusValue
 from globus_action_provider_tools.data_types import ActionRequest
 from globus_action_provider_tools.storage import AbstractActionRepository
 
-action_database: Dict[str, ActionStatus] = {}
-request_database: Dict[str, Tuple[ActionRequest, str]] = {}
+LOCK_STRIPES = 64
+# ActionStatus fields holding the identities allowed in each role
+ROLE_FIELDS = ("creator_id", "monitor_by", "manage_by")
 
 class ActionRepo(AbstractActionRepository):
-    repo: dict = {}
+    """
+    In-memory action store which also indexes action ids by status, so
+    enumeration only visits actions in the requested states.
+
+    Writes to a single action are serialised on one of LOCK_STRIPES locks
+    chosen by action id, so handlers running on different threads can't
+    interleave a status transition for the same action.
+    """
+
+    def __init__(self):
+        self.repo: Dict[str, ActionStatus] = {}
+        self.status_index: Dict[ActionStatusValue, Set[str]] = defaultdict(set)
+        # Status each action id is currently indexed under. ActionStatus
+        # objects are mutated in place, so this can't be read off the object.
+        self._indexed_status: Dict[str, ActionStatusValue] = {}
+        # Identities per role for each action, built once on store
+        self._role_index: Dict[str, Dict[str, FrozenSet[str]]] = {}
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
 
     def get(self, action_id: str):
         return self.repo.get(action_id, None)
 
     def store(self, action: ActionStatus):
-        self.repo[action.action_id] = action
+        with self._lock_for(action.action_id):
+            self.repo[action.action_id] = action
+            self._role_index[action.action_id] = {
+                role: _as_identity_set(getattr(action, role)) for role in ROLE_FIELDS
+            }
+            self._reindex(action)
 
     def remove(self, action: ActionStatus):
-        del self.repo[action.action_id]
\ No newline at end of file
+        with self._lock_for(action.action_id):
+            # pop, so concurrent releases of one action don't fail on the second
+            if self.repo.pop(action.action_id, None) is None:
+                return
+            self._role_index.pop(action.action_id, None)
+            status = self._indexed_status.pop(action.action_id, None)
+            if status is not None:
+                self.status_index[status].discard(action.action_id)
+
+    def update_status(self, action_id: str, status: ActionStatusValue,
+                      display_status: Optional[str] = None,
+                      expected: Optional[Collection[ActionStatusValue]] = None,
+                      completion_time: Optional[str] = None,
+                      details: Optional[Dict[str, Any]] = None
+                      ) -> Optional[ActionStatus]:
+        """
+        Move an action to a new status. If expected is given the transition
+        only happens when the current status is one of those values, and
+        None is returned otherwise (compare-and-set). completion_time and
+        details are set in the same locked step, so readers never see a
+        terminal status without them.
+        """
+        with self._lock_for(action_id):
+            action = self.repo[action_id]
+            if expected is not None and action.status not in expected:
+                return None
+            action.status = status
+            action.display_status = display_status or status
+            if completion_time is not None:
+                action.completion_time = completion_time
+            if details is not None:
+                action.details = details
+            self._reindex(action)
+            return action
+
+    def by_status(self, statuses: Iterable[ActionStatusValue]) -> Iterator[ActionStatus]:
+        # tuple() copies each set in one step, so concurrent writers can't
+        # change it mid-iteration
+        ids = list(chain.from_iterable(tuple(self.status_index[s]) for s in statuses))
+        actions = (self.repo.get(action_id) for action_id in ids)
+        return (action for action in actions if action is not None)
+
+    def allowed_identities(self, action: ActionStatus, roles: Iterable[str]) -> FrozenSet[str]:
+        """
+        Union of the identities holding any of the given roles on an action.
+        """
+        index = self._role_index.get(action.action_id, {})
+        return frozenset().union(*(
+            index[role] if role in index else _as_identity_set(getattr(action, role))
+            for role in roles
+        ))
+
+    def _lock_for(self, action_id: str) -> threading.Lock:
+        return self._locks[hash(action_id) % LOCK_STRIPES]
+
+    def _reindex(self, action: ActionStatus):
+        previous = self._indexed_status.get(action.action_id)
+        if previous == action.status:
+            return
+        if previous is not None:
+            self.status_index[previous].discard(action.action_id)
+        self.status_index[action.status].add(action.action_id)
+        self._indexed_status[action.action_id] = action.status
+
+def _as_identity_set(identities) -> FrozenSet[str]:
+    if isinstance(identities, str):
+        return frozenset((identities,))
+    return frozenset(identities or ())
+
+action_database = ActionRepo()
+request_database: Dict[str, Tuple[ActionRequest, str]] = {}
+# request_database key for each registered action id, so the entry can be
+# dropped when the action is released
+request_keys: Dict[str, str] = {}
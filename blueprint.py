@@ -1,12 +1,13 @@
 from datetime import datetime, timezone
+from types import MappingProxyType
 from typing import Dict, List, Set
 
-from flask import request
+from flask import Flask, current_app, request
 from pydantic import BaseModel, Field
 
 import os
-import sys
-import docker
+import time
+from docker.errors import NotFound
 
 from lp_ap_tools.lp_ap_tools import LP_artefact, add_lp_params, print_attributes
 
@@ -28,7 +29,7 @@ from globus_action_provider_tools.flask.types import (
     ActionLogReturn,
 )
 
-from backend import action_database, request_database
+from backend import action_database, request_database, request_keys
 
 # Globals for directory locations 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -36,7 +37,19 @@ INPUT_DIR = os.path.join(CURRENT_DIR, 'input') # AP inputs for method execution
 OUTPUT_DIR = os.path.join(CURRENT_DIR, 'output') # Generated outputs
 METHOD_DIR = os.path.join(CURRENT_DIR, 'method_resources') # Resources for method execution (e.g. Model, code, etc.)
 CRATES_DIR = os.path.join(CURRENT_DIR, 'crates') # ROcrate location for each action
-directory_structure = {"input": INPUT_DIR, "output": OUTPUT_DIR, "method": METHOD_DIR, "crates": CRATES_DIR}
+# Read-only base layout; each action's output directory is derived from it
+# in action_directories
+directory_structure = MappingProxyType({"input": INPUT_DIR, "output": OUTPUT_DIR, "method": METHOD_DIR, "crates": CRATES_DIR})
+# Only the end of the container output is kept in the action details, which
+# are returned on every status poll and enumeration
+OUTPUT_TAIL_BYTES = 4 * 1024
+# How long a duplicate submission waits for the first one to store its action
+REGISTRATION_WAIT_SECONDS = 1.0
+
+def action_directories(action_id: str) -> MappingProxyType:
+    # Each action writes to its own output directory, so actions running at
+    # the same time don't pick up each other's files in their RO-Crates
+    return MappingProxyType({**directory_structure, "output": os.path.join(OUTPUT_DIR, action_id)})
 
 class ActionProviderInput(BaseModel):
     # Defines the required input for the Action Provider (E.G. directories to process)
@@ -55,13 +68,16 @@ class ActionProviderInput(BaseModel):
 # Using lp_ap_tools, we can add LP fields to the ActionProviderInput 
 # post-hoc, providing flexibility in the chosen fields.
 ActionProviderInput = add_lp_params(ActionProviderInput)
+# Pydantic caches the generated JSON schema on the model; build it here so
+# the first introspection/run request doesn't pay for it.
+ActionProviderInput.schema()
 
 # Configure Action Provider identity
 description = ActionProviderDescription(
     globus_auth_scope="",
     title="",
     admin_contact="",
-    synchronous=True,
+    synchronous=False,
     input_schema=ActionProviderInput,
     api_version="",
     subtitle="",
@@ -105,24 +121,23 @@ def action_enumeration(auth: AuthState, params: Dict[str, Set]) -> List[ActionSt
     statuses = params["statuses"]
     roles = params["roles"]
     matches = []
-
-    for _, action in action_database.items():
-        if action.status in statuses:
-            # Create a set of identities that are allowed to access this action,
-            # based on the roles being queried for
-            allowed_set = set()
-            for role in roles:
-                identities = getattr(action, role)
-                if isinstance(identities, str):
-                    allowed_set.add(identities)
-                else:
-                    allowed_set.update(identities)
-
-            # Determine if this request's auth allows access based on the
-            # allowed_set
+    # Many actions share the same identity sets, so only ask auth once per set
+    authorization_cache: Dict[frozenset, bool] = {}
+
+    # Only visit actions indexed under one of the requested statuses
+    for action in action_database.by_status(statuses):
+        # Set of identities that are allowed to access this action, based on
+        # the roles being queried for (precomputed per role on store)
+        allowed_set = action_database.allowed_identities(action, roles)
+
+        # Determine if this request's auth allows access based on the
+        # allowed_set
+        authorized = authorization_cache.get(allowed_set)
+        if authorized is None:
             authorized = auth.check_authorization(allowed_set)
-            if authorized:
-                matches.append(action)
+            authorization_cache[allowed_set] = authorized
+        if authorized:
+            matches.append(action)
 
     return matches
 
@@ -135,30 +150,14 @@ def my_action_run(action_request: ActionRequest, auth: AuthState) -> ActionCallb
     """
     
     # Regestration of action
-    print('Action running', file=sys.stderr)
-    print(f'Action request ID: {action_request.request_id}', file=sys.stderr)
+    current_app.logger.debug("Action running, request id=%s", action_request.request_id)
 
     # Regester action request to parse out continuing requests
     caller_id = auth.effective_identity
-    # Modify full request id if multiple requests are able to be 
-    # made simultaniously from the same caller_id
-    full_request_id = f"{caller_id}"
-    prev_request = request_database.get(full_request_id)
+    # Key on the caller and the client supplied request_id, so retries of
+    # the same submission match while distinct submissions don't collide
+    full_request_id = f"{caller_id}:{action_request.request_id}"
 
-    if prev_request is not None:
-        """
-        NOTE: This is needed because the Globus client sends multiple
-        post requests to the server when starting an action. This stops 
-        further requests once a unique action is logged, and returns 
-        the status of the currently logged request.
-        """
-        if prev_request[0] == request:
-            return my_action_status(prev_request[1], auth)
-        else:
-            raise ActionConflict(
-                f"Request with id {full_request_id} already present with different parameters"
-            )
-        
     action_status = ActionStatus(
         status=ActionStatusValue.ACTIVE,
         creator_id=str(auth.effective_identity),
@@ -171,25 +170,96 @@ def my_action_run(action_request: ActionRequest, auth: AuthState) -> ActionCallb
         display_status=ActionStatusValue.ACTIVE,
         details={},
     )
-    # Update action_database with action object
-    action_database[action_status.action_id] = action_status
-    # update request_database with unique request ID
-    request_database[full_request_id] = (request, action_status.action_id)
+    # update request_database with unique request ID. setdefault checks and
+    # inserts in one step, so only one of several concurrent submissions
+    # registers its action, and only that one is stored.
+    registered = (action_request, action_status.action_id)
+    prev_request = request_database.setdefault(full_request_id, registered)
 
-    print(request_database[full_request_id])
+    if prev_request is not registered:
+        """
+        NOTE: This is needed because the Globus client sends multiple
+        post requests to the server when starting an action. This stops 
+        further requests once a unique action is logged, and returns 
+        the status of the currently logged request.
+        """
+        if prev_request[0] != action_request:
+            raise ActionConflict(
+                f"Request with id {full_request_id} already present with different parameters"
+            )
+        # The winning submission stores its action right after registering
+        # it; wait briefly for that rather than report an unknown action id
+        deadline = time.monotonic() + REGISTRATION_WAIT_SECONDS
+        while action_database.get(prev_request[1]) is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return my_action_status(prev_request[1], auth)
 
-    # Example logic for running an action
-    run_computation(ap_description=description, 
-                    ap_request=action_request, 
-                    ap_status=action_status,
-                    ap_auth=auth,
-                    ap_apbt=aptb,
-                    raw_request=request_database[full_request_id]) 
+    # Update action_database with action object
+    action_database.store(action_status)
+    request_keys[action_status.action_id] = full_request_id
+
+    # Example logic for running an action. The computation runs on the
+    # app's executor so the ACTIVE status is returned straight away and
+    # Globus polls my_action_status for completion.
+    current_app.extensions['executor'].submit(
+        run_in_app_context,
+        current_app._get_current_object(),
+        ap_description=description, 
+        ap_request=action_request, 
+        ap_status=action_status,
+        ap_auth=auth,
+        ap_apbt=aptb,
+        # LP_artefact reads the URL off the Flask request; pass the concrete
+        # object, the context-local proxy is unbound in the worker thread
+        raw_request=(request._get_current_object(), action_status.action_id)) 
 
     return action_status
 
-# LP artefact decorator for ROcrate management
-@LP_artefact(dir_struct=directory_structure)
+def run_in_app_context(app: Flask, **kwargs):
+    # Executor threads have no app context, which run_computation needs.
+    # The final status is set here, once LP_artefact has also written and
+    # transferred the crate, and errors are logged rather than left on the
+    # executor's future.
+    action_id = kwargs["ap_status"].action_id
+    dir_struct = action_directories(action_id)
+    with app.app_context():
+        try:
+            os.makedirs(dir_struct["output"], exist_ok=True)
+            # LP artefact decorator for ROcrate management, applied per action
+            # so the crate only collects this action's output
+            details = LP_artefact(dir_struct=dir_struct)(run_computation)(**kwargs)
+        except Exception as error:
+            app.logger.exception("Action %s failed", action_id)
+            # display_status is limited to 64 characters; the cause goes in
+            # details. This covers LP_artefact's crate handling as well as
+            # the container run.
+            action_database.update_status(
+                action_id,
+                ActionStatusValue.FAILED,
+                "Action failed",
+                expected=(ActionStatusValue.ACTIVE,),
+                completion_time=datetime.now(timezone.utc).isoformat(),
+                details={"error": str(error)},
+            )
+            return
+
+    # Update and re-regester action, unless it was cancelled meanwhile.
+    # A non-zero container exit code fails the action.
+    if details["exit_code"] == 0:
+        status, display_status = ActionStatusValue.SUCCEEDED, None
+    else:
+        status = ActionStatusValue.FAILED
+        display_status = f"Computation exited with code {details['exit_code']}"
+    action_database.update_status(
+        action_id,
+        status,
+        display_status,
+        expected=(ActionStatusValue.ACTIVE,),
+        completion_time=datetime.now(timezone.utc).isoformat(),
+        details=details,
+    )
+
+# Wrapped with LP_artefact per action in run_in_app_context
 def run_computation(ap_description: ActionProviderDescription, 
                     ap_request: ActionRequest, 
                     ap_status: ActionStatus,
@@ -201,42 +271,59 @@ def run_computation(ap_description: ActionProviderDescription,
     # ----------- docker containersation -----------
     # ----------------------------------------------
 
-    client = docker.from_env()
-    # bind constant input/output directories to import and export data 
-    # between the external context and the container
+    # Reuse the Docker client created by the app factory
+    client = current_app.extensions['docker']
+    # bind the input directory and this action's output directory to import
+    # and export data between the external context and the container
     volumes = {
         INPUT_DIR: {'bind': '/computation/input', 'mode': 'rw'},
-        OUTPUT_DIR: {'bind': '/computation/output', 'mode': 'rw'}
+        action_directories(ap_status.action_id)["output"]: {'bind': '/computation/output', 'mode': 'rw'}
     }
 
+    container_id = None
     try: 
-        print("Executing container")
-        # Image is built and named in app.py
-        container = client.containers.run(
+        current_app.logger.debug("Executing container for action %s", ap_status.action_id)
+        # Image is built and named in app.py. The low-level API avoids the
+        # extra inspect/reload calls of the containers.run helper (attach
+        # still does its own inspect to check for a tty).
+        container_id = client.api.create_container(
             image='computation_image:latest',
-            volumes=volumes,
             command=[ap_request.body["input_data"]],
-            detach=True)
-        # wait for the container to finish
-        print(container)
-        container.wait()
+            host_config=client.api.create_host_config(binds=volumes))['Id']
+        # Attach before starting so no output is missed; the stream is read
+        # as it is produced and ends when the container exits
+        output_stream = client.api.attach(
+            container_id, stdout=True, stderr=True, stream=True, logs=True)
+        client.api.start(container_id)
+        output = bytearray()
+        truncated = False
+        for chunk in output_stream:
+            output += chunk
+            if len(output) > OUTPUT_TAIL_BYTES:
+                del output[:-OUTPUT_TAIL_BYTES]
+                truncated = True
+        if truncated:
+            # The cut can land inside a UTF-8 sequence; drop its leftover
+            # continuation bytes (0b10xxxxxx) rather than decode them to U+FFFD
+            start = 0
+            while start < min(3, len(output)) and output[start] & 0xC0 == 0x80:
+                start += 1
+            del output[:start]
+        # wait blocks on the daemon until the container exits (no polling)
+        result = client.api.wait(container_id)
+        return {
+            "exit_code": result["StatusCode"],
+            "output": output.decode("utf-8", errors="replace"),
+        }
 
-    except Exception as e:
-        print(e)
-    
     finally:
-        # If the conatiner is still running, stop it
-        if container.status == 'running':
-            container.stop()
-        # Remove the container
-        container.remove()
-
-        # Update and re-regester action
-        action_status = action_database.get(ap_status.action_id)
-        action_status.completion_time=datetime.now(timezone.utc).isoformat()
-        action_status.status=ActionStatusValue.SUCCEEDED
-        action_status.display_status=ActionStatusValue.SUCCEEDED
-        action_database[ap_status.action_id] = action_status
+        # Remove the container and its anonymous volumes; force stops it
+        # server-side if it is somehow still running
+        if container_id is not None:
+            try:
+                client.api.remove_container(container_id, v=True, force=True)
+            except NotFound:
+                pass
 
 @aptb.action_status
 def my_action_status(action_id: str, auth: AuthState) -> ActionCallbackReturn:
@@ -265,12 +352,17 @@ def my_action_cancel(action_id: str, auth: AuthState) -> ActionCallbackReturn:
         raise ActionNotFound(f"No action with {action_id}")
 
     authorize_action_management_or_404(action_status, auth)
-    if action_status.is_complete():
-        raise ActionConflict("Cannot cancel complete action")
 
-    action_status.status = ActionStatusValue.FAILED
-    action_status.display_status = f"Cancelled by {auth.effective_identity}"
-    action_database[action_id] = action_status
+    # Compare-and-set so a cancel racing with completion can't overwrite it
+    action_status = action_database.update_status(
+        action_id,
+        ActionStatusValue.FAILED,
+        f"Cancelled by {auth.effective_identity}",
+        expected=(ActionStatusValue.ACTIVE, ActionStatusValue.INACTIVE),
+        completion_time=datetime.now(timezone.utc).isoformat(),
+    )
+    if action_status is None:
+        raise ActionConflict("Cannot cancel complete action")
     return action_status
 
 
@@ -290,7 +382,12 @@ def my_action_release(action_id: str, auth: AuthState) -> ActionCallbackReturn:
         raise ActionConflict("Cannot release incomplete Action")
 
     action_status.display_status = f"Released by {auth.effective_identity}"
-    # TODO action is not actually release (e.g. removed form backend database)
+    # Remove the action and its request entry, so neither database grows
+    # with every action run
+    full_request_id = request_keys.pop(action_id, None)
+    if full_request_id is not None:
+        request_database.pop(full_request_id, None)
+    action_database.remove(action_status)
 
     return action_status
 